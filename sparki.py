@@ -2,8 +2,53 @@
 Sparki library communicating with ESP32 over UDP socket.
 Yoshiro Fujita, 9/13/2022
 """
-import socket, logging, time
-
+import socket, select, struct, numbers, logging, time
+
+
+_DNS_CACHE = {}
+
+# Fixed command strings, kept as bytes so they go straight onto the wire
+_MOVE = {"forward": b"V1", "f": b"V1",
+         "backward": b"V-1", "b": b"V-1",
+         "stop": b"V0", "s": b"V0"}
+_TURN = {"right": b"T1", "r": b"T1",
+         "left": b"T-1", "l": b"T-1",
+         "stop": b"T0", "s": b"T0"}
+_GRIPPER = {"open": b"G1", "o": b"G1",
+            "close": b"G-1", "c": b"G-1",
+            "stop": b"G0", "s": b"G0"}
+_STOP = b"X"
+_NOBEEP = b"e0"
+
+# Little-endian sensor packets used when Sparki(binary=True)
+_PING = struct.Struct("<f")
+_LIDAR = struct.Struct("<h")
+_LINE = struct.Struct("<5h")
+_LIGHT = struct.Struct("<3h")
+_XYZ = struct.Struct("<3h")
+
+# Not defined on Windows; the socket is non-blocking regardless
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+_shared_sock = None
+
+def _get_shared_socket():
+    """Module-wide UDP socket, created on first use"""
+    global _shared_sock
+    if _shared_sock is None:
+        _shared_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        _shared_sock.setblocking(False)
+    return _shared_sock
+
+def _resolve(name, ttl=300):
+    """Resolve hostname, reusing a cached IP until its TTL expires"""
+    now = time.monotonic()
+    entry = _DNS_CACHE.get(name)
+    if entry is not None and now < entry[1]:
+        return entry[0]
+    ip = socket.gethostbyname(name)
+    _DNS_CACHE[name] = (ip, now + ttl)
+    return ip
 
 
 class CircularBuffer:
@@ -11,37 +56,54 @@ class CircularBuffer:
         self.data = [0] * length
         self.length = length
         self.index = 0
+        self.count = 0
+        self._sum = 0
+        self._nz = 0
 
     def add(self, data):
+        old = self.data[self.index]
+        self._sum += data - old
+        self._nz += (data != 0) - (old != 0)
         self.data[self.index] = data
-        self.index += 1
-        if self.index >= self.length:
-            self.index = 0
+        self.index = (self.index + 1) % self.length
+        self.count += 1
 
     def avg(self):
-        if self.data.count(0) == self.length:
+        if self._nz == 0:
             return 100
         else:
-            return sum(self.data) / (self.length - self.data.count(0))
+            return self._sum / self._nz
 
 
 class ESP32:
-    def __init__(self, name=None, ip=None, port=3141):
-        """Create custom logger"""
+    def __init__(self, name=None, ip=None, port=3141, shared_socket=False):
+        """Create custom logger and UDP socket.
+
+        shared_socket=True reuses one module-wide socket across instances. It is
+        single-threaded only: a reader discards replies from other addresses, so
+        instances polled concurrently from different threads lose each other's replies.
+        """
         self.logger = logging.getLogger(__name__)
-        c_handler = logging.StreamHandler()
-        c_format= logging.Formatter(fmt='%(asctime)s.%(msecs)03d:   %(message)s', datefmt='%H:%M:%S')
-        c_handler.setLevel(logging.DEBUG)
-        c_handler.setFormatter(c_format)
-        self.logger.addHandler(c_handler)
+        if not self.logger.handlers:
+            c_handler = logging.StreamHandler()
+            c_format= logging.Formatter(fmt='%(asctime)s.%(msecs)03d:   %(message)s', datefmt='%H:%M:%S')
+            c_handler.setLevel(logging.DEBUG)
+            c_handler.setFormatter(c_format)
+            self.logger.addHandler(c_handler)
         self.logger.setLevel(logging.INFO)
 
         
-        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        self.socket.settimeout(1)
+        self.shared_socket = shared_socket
+        if shared_socket:
+            self.set_socket(_get_shared_socket())
+        else:
+            sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.set_socket(sock)
+        self._rxbuf = bytearray(300)
+        self._rxmv = memoryview(self._rxbuf)
         self.timeout_errors = CircularBuffer(5)
-        self.last_timeout = time.time()
-        self.socket.setblocking(1)
+        self.last_timeout = time.monotonic()
         self.name = name
         self.ip = ip
         self.port = port
@@ -50,207 +112,174 @@ class ESP32:
             if ".local" not in name:
                 self.name += ".local"
                 
-            self.ip = socket.gethostbyname(self.name)
+            self.ip = _resolve(self.name)
             self.address = (self.ip, port)
         elif ip != None:
-            self.address = (ip, port)
+            if shared_socket:
+                # Replies are matched against recvfrom's dotted-quad address
+                self.ip = _resolve(ip)
+            self.address = (self.ip, port)
         else:
             raise Exception("Require valid host or IP.")
-        self.logger.info(f"ESP32 Address set to {self.address}")
+        self.logger.info("ESP32 Address set to %s", self.address)
 
 
 
-    def udp_send(self, msg):
-        self.socket.sendto(msg.encode("utf-8"), self.address)
-        self.logger.debug(f"Sent {msg}")
+    def set_socket(self, sock):
+        """Use sock for all traffic, caching its bound methods for the send/receive paths"""
+        self.socket = sock
+        self._rlist = [sock]
+        self._sendto = sock.sendto
+        self._recvfrom_into = sock.recvfrom_into
 
-    def udp_get(self, timeout=0.2):
-        self.socket.settimeout(timeout)
-        self.logger.debug(f"Waiting to receive...")
+    def udp_send(self, msg):
+        if not isinstance(msg, bytes):
+            msg = msg.encode("utf-8")
         try:
-            msg = self.socket.recvfrom(300)
-            self.logger.debug(f"Received {msg}")
-            return msg[0].decode("utf-8")
+            self._sendto(msg, _MSG_DONTWAIT, self.address)
+        except BlockingIOError:
+            # Send buffer full: wait for it to drain, then retry once
+            try:
+                if not select.select([], [self.socket], [], 1)[1]:
+                    raise BlockingIOError
+                self._sendto(msg, self.address)
+            except BlockingIOError:
+                raise Exception("UDP send buffer full, command not sent. Check network connection.")
+        self.logger.debug("Sent %s", msg)
+
+    def udp_get(self, timeout=0.2, raw=False):
+        self.logger.debug("Waiting to receive...")
+        # timeout=None blocks until a reply arrives
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                if not select.select(self._rlist, [], [], wait)[0]:
+                    raise TimeoutError
+                try:
+                    nbytes, addr = self._recvfrom_into(self._rxbuf, 300)
+                except BlockingIOError:
+                    # Readable but nothing to read (datagram discarded or taken by another reader)
+                    continue
+                # A shared socket also receives replies meant for other instances
+                if not self.shared_socket or addr == self.address:
+                    break
+                self.logger.debug("Dropped packet from %s", addr)
+            msg = bytes(self._rxmv[:nbytes]) if raw else str(self._rxmv[:nbytes], "utf-8")
+            self.logger.debug("Received %s from %s", msg, addr)
+            return msg
         except TimeoutError:
-            now = time.time()
+            now = time.monotonic()
             self.timeout_errors.add(now - self.last_timeout)
             self.last_timeout = now
             period = self.timeout_errors.avg()
-            self.logger.error(f"Timeout Error. Timeout = {timeout:.1f} seconds (avg timeout frequency = 1 per {period:.3f} seconds)")
-            if period < 0.100:
+            self.logger.error("Timeout Error. Timeout = %.1f seconds (avg timeout frequency = 1 per %.3f seconds)", timeout, period)
+            # Only throttle once the buffer has filled twice, so startup timeouts don't trip it
+            if self.timeout_errors.count >= 2 * self.timeout_errors.length and period < 0.100:
                 raise Exception("Timeouts occurring too frequently. Try resetting Sparki.")
             return 0
 
 
     def set_logger_level(self, level):
-        level_dict = { "debug"   : logging.DEBUG,
-                       "info"    : logging.INFO,
-                       "warning" : logging.WARNING,
-                       "error"   : logging.ERROR }
-        self.logger.setLevel(level_dict[level.lower()])
+        """Set logger level by name: debug, info, warning, error or critical"""
+        self.logger.setLevel(getattr(logging, level.upper()))
 
 
 class Sparki(ESP32):
-    def __init__(self, name=None, ip=None, port=3141):
-        ESP32.__init__(self, name, ip, port)
+    def __init__(self, name=None, ip=None, port=3141, shared_socket=False, binary=False):
+        """binary=True expects firmware that answers sensor queries with packed little-endian values.
+        shared_socket=True is single-threaded only (see ESP32.__init__)."""
+        ESP32.__init__(self, name, ip, port, shared_socket)
+        self.binary = binary
         self.command_count = 0
         self.command_time = 0
+        self.enable_stats = True
         self.stop()
 
+    def refresh_dns(self):
+        """Drop cached IP for this host and resolve it again (e.g. after a network change)"""
+        if self.name == None:
+            return
+        _DNS_CACHE.pop(self.name, None)
+        self.ip = _resolve(self.name)
+        self.address = (self.ip, self.port)
+        self.logger.info("ESP32 Address set to %s", self.address)
+
     def send(self, msg):
         self.udp_send(msg)
 
-    def get(self, msg, timeout=1):
-        t0 = time.time()
+    def get(self, msg, timeout=1, raw=False):
+        if self.enable_stats:
+            t0 = time.monotonic()
         self.send(msg)
-        response = self.udp_get(timeout)
-        self.command_time += time.time() - t0
-        self.command_count += 1
-        if type(response) == str and "NACK" in response:
+        response = self.udp_get(timeout, raw)
+        if self.enable_stats:
+            self.command_time += time.monotonic() - t0
+            self.command_count += 1
+        if isinstance(response, str) and "NACK" in response or \
+           isinstance(response, bytes) and response.startswith(b"NACK"):
             raise Exception("ESP-Sparki NACK: Try resetting Sparki.")
             return 0
         return response
 
-    """ Sparki Outputs """  
-    def move(self, distance):
-        msg = "V"
-        forward = ["forward", "f"]
-        backward = ["backward", "b"]
-        stop = ["stop", "s"]
-
-        indef = True
-
-        if type(distance) == str:
-            if distance.lower() in forward:
-                msg += "1"
-            elif distance.lower() in backward:
-                msg += "-1"
-            elif distance.lower() in stop:
-                msg += "0"
-            else:
-                raise Exception("Do not recognize linear movement parameter. Must be FORWARD, BACKWARD, or STOP")
-        elif type(distance) == int or type(distance) == float:
-            msg = "v"
-            msg += str(round(distance,2))
-            indef = False
-        else:
-            raise Exception("Do not recognize linear movement parameter. Must be FORWARD, BACKWARD, or STOP")
-        
-        if indef:
-            self.send(msg)
+    """ Sparki Outputs """
+    def _directional(self, param, prefix, commands, timeout_factor, error):
+        """Shared dispatch for move/turn/gripper: keyword -> indefinite command, number -> blocking command"""
+        if isinstance(param, str):
+            cmd = commands.get(param.lower())
+            if cmd is None:
+                raise Exception(error)
+            self.send(cmd)
+        elif isinstance(param, numbers.Real) and not isinstance(param, bool):
+            self.get(prefix + str(round(param, 2)), max(abs(param) * timeout_factor, 1))
         else:
-            r = self.get(msg, max(abs(distance) * 0.5, 1))
+            raise Exception(error)
 
-    def turn(self, angle):
-        msg = "T"
-        right = ["right", "r"]
-        left = ["left", "l"]
-        stop = ["stop", "s"]
+    def move(self, distance):
+        self._directional(distance, "v", _MOVE, 0.5,
+                          "Do not recognize linear movement parameter. Must be FORWARD, BACKWARD, or STOP")
 
-        indef = True
-        
-        if type(angle) == str:
-            if angle.lower() in right:
-                msg += "1"
-            elif angle.lower() in left:
-                msg += "-1"
-            elif angle.lower() in stop:
-                msg += "0"
-            else:
-                raise Exception("Do not recognize turning parameter. Must be RIGHT, LEFT, or STOP")
-        elif type(angle) == int or type(angle) == float:
-            msg = "t"
-            msg += str(round(angle,2))
-            indef = False
-        else:
-            raise Exception("Do not recognize turning parameter. Must be RIGHT, LEFT, or STOP")
-        
-        if indef:
-            self.send(msg)
-        else:
-            self.get(msg, max(abs(angle) * 0.05, 1))
+    def turn(self, angle):
+        self._directional(angle, "t", _TURN, 0.05,
+                          "Do not recognize turning parameter. Must be RIGHT, LEFT, or STOP")
     
     def stop(self):
-        self.send("X")
+        self.send(_STOP)
 
     def motors(self, speeds):
         if len(speeds) < 2:
             self.logger.error("Not enough speeds specified")
         else:
-            if speeds[0] < -100:
-                speeds[0] = -100
-            elif speeds[0] > 100:
-                speeds[0] = 100
-                
-            if speeds[1] < -100:
-                speeds[1] = -100
-            elif speeds[1] > 100:
-                speeds[1] = 100
-                
-            msg = "m"
-            if speeds[0] == None:
-                speeds[0] = 400
-            if speeds[1] == None:
-                speeds[1] = 400
-            msg += str(int(speeds[0])+100)
-            msg += "."
-            msg += str(int(speeds[1])+100)
-        
-        self.send(msg)
-        
+            s0, s1 = speeds[0], speeds[1]
+            s0 = 400 if s0 is None else max(-100, min(100, s0))
+            s1 = 400 if s1 is None else max(-100, min(100, s1))
+            self.send(b"m%d.%d" % (int(s0)+100, int(s1)+100))
     
     def gripper(self, distance):
-        msg = 'G'
-        g_open = ["open", "o"]
-        g_close = ["close", "c"]
-        g_stop = ["stop", "s"]
-
-        indef = True
-
-        if type(distance) == str:
-            if distance.lower() in g_open:
-                msg += "1"
-            elif distance.lower() in g_close:
-                msg += "-1"
-            elif distance.lower() in g_stop:
-                msg += "0"
-            else:
-                raise Exception("Do not recognize gripper parameter. Must be OPEN, CLOSE, or STOP")
-        elif type(distance) == int or type(distance) == float:
-            msg = "g"
-            msg += str(round(distance, 2))
-            indef = False
-        else:
-            raise Exception("Do not recognize gripper parameter. Must be OPEN, CLOSE, or STOP")    
-
-        if indef:
-            self.send(msg)
-        else:
-            self.get(msg, max(abs(distance), 1))
+        self._directional(distance, "g", _GRIPPER, 1,
+                          "Do not recognize gripper parameter. Must be OPEN, CLOSE, or STOP")
 
     def servo(self, angle):
-        self.send("s" + str(int(angle)))
+        self.send(b"s%d" % int(angle))
 
     def led(self, color):
         if len(color) < 3:
             self.logger.error("Need RED, GREEN, and BLUE values")
         else:
-            msg = "dr" + str(int(color[0])) + "g" + str(int(color[1])) + "b" + str(int(color[2]))
-            self.send(msg)
+            self.send(b"dr%dg%db%d" % (int(color[0]), int(color[1]), int(color[2])))
 
     def beep(self, frequency = 110, duration = 0.2):
-        msg = "e1f" + str(int(frequency)) + "d" + str(round(duration,3)) 
-        self.send(msg)
+        self.send(b"e1f%dd%.3f" % (int(frequency), duration))
 
     def nobeep(self):
-        self.send("e0")
+        self.send(_NOBEEP)
         
 
     """ Sparki Inputs """
     def ping(self, timeout=0.5):
-        r = self.get("p", timeout)
+        r = self.get("p", timeout, self.binary)
         try:
-            distance = float(r)
+            distance = _PING.unpack_from(r)[0] if self.binary else float(r)
         except:
             self.logger.error("Received non-numeric value from ping()")
             distance = 54321
@@ -259,9 +288,9 @@ class Sparki(ESP32):
         return distance
 
     def lidar(self, timeout=0.1):
-        r = self.get("L", timeout)
+        r = self.get("L", timeout, self.binary)
         try:
-            distance = float(r)/10.0
+            distance = (_LIDAR.unpack_from(r)[0] if self.binary else float(r))/10.0
         except:
             self.logger.error("Received non-numeric value from lidar()")
             distance = 54321
@@ -272,56 +301,56 @@ class Sparki(ESP32):
         return distance
 
     def line(self, as_list = False, timeout=0.1):
-        r = self.get("n", timeout)
+        r = self.get("n", timeout, self.binary)
         try:
-            lines = r.split()
-        except:
+            lines = _LINE.unpack_from(r) if self.binary else r.split()
+        except (AttributeError, TypeError, struct.error):
             self.logger.error("Unexpected line vector response")
-            lines = [0, 0, 0, 0, 0]
+            lines = ["0"] * 5
         if as_list:
-            return [int(lines[i]) for i in range(len(lines))]
+            return list(map(int, lines))
         else:
-            keys = ["edge left", "left", "center", "right", "edge right"] 
-            return {keys[i]: float(lines[i]) for i in range(min(len(lines), len(keys)))}
+            keys = ["edge left", "left", "center", "right", "edge right"]
+            return dict(zip(keys, map(float, lines)))
         
     def light(self, as_list = False, timeout=0.1):
-        r = self.get("l", timeout)
+        r = self.get("l", timeout, self.binary)
         try:
-            lights = r.split()
-        except:
+            lights = _LIGHT.unpack_from(r) if self.binary else r.split()
+        except (AttributeError, TypeError, struct.error):
             self.logger.error("Unexpected light vector response")
-            lights = [0, 0, 0, 0, 0]
+            lights = ["0"] * 5
         if as_list:
-            return [int(lights[i]) for i in range(len(lights))]
+            return list(map(int, lights))
         else:
             keys = ["left", "center", "right"]
-            return {keys[i]: float(lights[i]) for i in range(min(len(lights), len(keys)))}
+            return dict(zip(keys, map(float, lights)))
 
     def accel(self, as_list = False, timeout=0.05):
-        r = self.get("a")
+        r = self.get("a", timeout, self.binary)
         try:
-            accels = r.split()
-        except:
+            accels = _XYZ.unpack_from(r) if self.binary else r.split()
+        except (AttributeError, TypeError, struct.error):
             self.logger.error("Unexpected line vector response")
-            accels = [0, 0, 0, 0, 0]
+            accels = ["0"] * 5
         if as_list:
-            return [int(accel[i]) for i in range(len(accels))]
+            return list(map(int, accels))
         else:
             keys = ["x", "y", "z"]
-            return {keys[i]: float(accels[i])/1000.0 for i in range(min(len(accels), len(keys)))}
+            return dict(zip(keys, (float(v)/1000.0 for v in accels)))
             
     def mag(self, as_list = False, timeout=0.05):
-        r = self.get("c", timeout)
+        r = self.get("c", timeout, self.binary)
         try:
-            mags = r.split()
-        except:
+            mags = _XYZ.unpack_from(r) if self.binary else r.split()
+        except (AttributeError, TypeError, struct.error):
             self.logger.error("Unexpected line vector response")
-            mags = [0, 0, 0, 0, 0]
+            mags = ["0"] * 5
         if as_list:
-            return [int(mags[i]) for i in range(len(mags))]
+            return list(map(int, mags))
         else:
             keys = ["x", "y", "z"]
-            return {keys[i]: float(mags[i])/1000.0 for i in range(min(len(mags), len(keys)))}
+            return dict(zip(keys, (float(v)/1000.0 for v in mags)))
 
     def battery(self):
         r = self.get("b")